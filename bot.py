@@ -1,13 +1,16 @@
 import logging
+import contextlib
 import json
 import os
 import time
 import asyncio
 import httpx
+import aiosqlite
+from cachetools import TTLCache
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters,
-    CallbackQueryHandler, ContextTypes, ConversationHandler
+    CallbackQueryHandler, ContextTypes, ConversationHandler, AIORateLimiter
 )
 
 # Импорт конфигурации
@@ -16,8 +19,12 @@ from config import (
     TMDB_MOVIE_URL, TMDB_GENRE_URL, TMDB_DISCOVER_URL, DATA_FILE
 )
 
-# --- Глобальный HTTP клиент ---
+# --- Глобальный HTTP клиент (создаётся в on_startup) ---
 http_client = None
+TMDB_CONFIGURATION_URL = 'https://api.themoviedb.org/3/configuration'
+
+# --- База данных (открывается в on_startup) ---
+db = None
 
 # --- Логирование ---
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -35,58 +42,149 @@ global_keyboard = ReplyKeyboardMarkup([
     ['/help']
 ], resize_keyboard=True)
 
+# --- Статические inline-клавиатуры (собираются один раз) ---
+_CLOSE_BUTTON = InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations")
+_CLOSE_MARKUP = InlineKeyboardMarkup([[_CLOSE_BUTTON]])
+_RECOMMEND_TYPE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton('По фильму', callback_data='by_film')],
+    [InlineKeyboardButton('По жанру', callback_data='by_genre')],
+])
+_SHOW_DELETE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🗑️ Удалить фильм", callback_data="show_delete_interface")]])
+_SHOW_UPDATED_LIST_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("📋 Показать обновленный список", callback_data="show_updated_list")]])
+_CANCEL_DELETE_ROW = [InlineKeyboardButton("❌ Отмена", callback_data="cancel_delete")]
+
 # --- Rate Limiting ---
-class RateLimiter:
-    def __init__(self, max_requests=10, time_window=1.0):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = []
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
     
     async def acquire(self):
-        now = time.time()
-        # Удаляем старые запросы
-        self.requests = [req_time for req_time in self.requests if now - req_time < self.time_window]
-        
-        if len(self.requests) >= self.max_requests:
-            # Ждем до освобождения слота
-            wait_time = self.time_window - (now - self.requests[0])
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
-        
-        self.requests.append(time.time())
+        async with self.lock:
+            now = time.monotonic()
+            # Пополняем токены за прошедшее время
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                # Ждем, пока накопится один токен, и сразу его тратим
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+                self.last = time.monotonic()
+            else:
+                self.tokens -= 1
 
 # Глобальный rate limiter для TMDB API
-tmdb_rate_limiter = RateLimiter(max_requests=8, time_window=1.0)  # 8 запросов в секунду
+tmdb_rate_limiter = TokenBucket(rate=8, capacity=8)  # 8 запросов в секунду
 
 # --- Вспомогательные функции ---
 def load_films():
+    # Старый формат хранения: весь список в одном JSON-файле
     if not os.path.exists(DATA_FILE):
         return {}
     with open(DATA_FILE, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def save_films(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def format_films_text(header, films):
+    parts = [header]
+    parts.extend(
+        f"{i}. {f['title']}" + (f" ({', '.join(f['genres'])})" if f['genres'] else '')
+        for i, f in enumerate(films, 1)
+    )
+    return '\n'.join(parts)
+
+async def init_db():
+    global db
+    db = await aiosqlite.connect(DATA_FILE + '.db')
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute('PRAGMA synchronous=NORMAL')
+    # PRIMARY KEY(user_id, film_id) одновременно служит индексом по user_id
+    await db.execute(
+        'CREATE TABLE IF NOT EXISTS films('
+        'user_id INTEGER, film_id INTEGER, title TEXT, genres TEXT, '
+        'PRIMARY KEY(user_id, film_id))'
+    )
+    await db.commit()
+    await migrate_json()
 
-# --- Получение жанров TMDB (кэшируем для ускорения) ---
-_genre_cache = None
+async def migrate_json():
+    # Однократный перенос данных из старого JSON-файла в SQLite
+    if not os.path.exists(DATA_FILE):
+        return
+    films = await asyncio.to_thread(load_films)
+    rows = [
+        (int(user_id), f['id'], f['title'], json.dumps(f.get('genres', []), ensure_ascii=False))
+        for user_id, user_films in films.items() for f in user_films
+    ]
+    await db.executemany('INSERT OR IGNORE INTO films VALUES (?, ?, ?, ?)', rows)
+    await db.commit()
+    os.replace(DATA_FILE, DATA_FILE + '.migrated')
+    logger.info(f"Migrated {len(rows)} films from {DATA_FILE}")
+
+async def close_db():
+    global db
+    if db:
+        await db.close()
+        db = None
+
+async def get_user_films(user_id):
+    async with db.execute(
+        'SELECT film_id, title, genres FROM films WHERE user_id = ? ORDER BY rowid', (user_id,)
+    ) as cursor:
+        rows = await cursor.fetchall()
+    return [{'id': film_id, 'title': title, 'genres': json.loads(genres)} for film_id, title, genres in rows]
+
+async def get_seen_ids(context, user_id):
+    # id фильмов пользователя кэшируются на время листания рекомендаций
+    seen_ids = context.user_data.get('seen_ids')
+    if seen_ids is None:
+        seen_ids = {f['id'] for f in await get_user_films(user_id)}
+        context.user_data['seen_ids'] = seen_ids
+    return seen_ids
+
+async def add_user_film(user_id, film_id, title, genres):
+    # Возвращает False, если фильм уже есть в списке пользователя
+    cursor = await db.execute(
+        'INSERT OR IGNORE INTO films(user_id, film_id, title, genres) VALUES (?, ?, ?, ?)',
+        (user_id, film_id, title, json.dumps(genres, ensure_ascii=False))
+    )
+    await db.commit()
+    return cursor.rowcount > 0
+
+async def delete_user_film(user_id, film_id):
+    await db.execute('DELETE FROM films WHERE user_id = ? AND film_id = ?', (user_id, film_id))
+    await db.commit()
+
+# --- Запросы к TMDB (кэшируем одинаковые запросы на 5 минут) ---
+_tmdb_cache = TTLCache(maxsize=1024, ttl=300)
+
+async def tmdb_get(url, params):
+    key = (url, tuple(sorted(params.items())))
+    data = _tmdb_cache.get(key)
+    if data is not None:
+        return data
+    await tmdb_rate_limiter.acquire()
+    resp = await http_client.get(url, params=params)
+    resp.raise_for_status()
+    data = resp.json()
+    _tmdb_cache[key] = data
+    return data
+
+# --- Получение жанров TMDB ---
+# Успешный ответ лежит в _tmdb_cache; после ошибки 30 секунд не ходим в TMDB повторно
+_genre_error_until = 0.0
 async def get_genres():
-    global _genre_cache, http_client
-    if _genre_cache:
-        return _genre_cache
-    if not http_client:
-        http_client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_keepalive_connections=5, max_connections=10))
-    
+    global _genre_error_until
+    if time.monotonic() < _genre_error_until:
+        return {}
     try:
-        await tmdb_rate_limiter.acquire()
-        resp = await http_client.get(TMDB_GENRE_URL, params={'api_key': TMDB_API_KEY, 'language': 'ru-RU'})
-        if resp.status_code == 200:
-            genres = {g['id']: g['name'] for g in resp.json().get('genres', [])}
-            _genre_cache = genres
-            return genres
+        data = await tmdb_get(TMDB_GENRE_URL, {'api_key': TMDB_API_KEY, 'language': 'ru-RU'})
+        return {g['id']: g['name'] for g in data.get('genres', [])}
     except Exception as e:
         logger.error(f"Error getting genres: {e}")
+        _genre_error_until = time.monotonic() + 30
     return {}
 
 # --- Команды ---
@@ -122,31 +220,35 @@ async def add_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
     title = update.message.text.strip()
     context.user_data['add_title'] = title
     logger.info(f"Searching for film: {title}")
+    # Жанры загружаем параллельно с поиском
+    genres_task = asyncio.create_task(get_genres())
     try:
-        global http_client
-        if not http_client:
-            http_client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_keepalive_connections=5, max_connections=10))
-        
-        await tmdb_rate_limiter.acquire()
-        resp = await http_client.get(TMDB_SEARCH_URL, params={'api_key': TMDB_API_KEY, 'query': title, 'language': 'ru-RU'})
-        resp.raise_for_status()
-        results = resp.json().get('results', [])
+        data = await tmdb_get(TMDB_SEARCH_URL, {'api_key': TMDB_API_KEY, 'query': title, 'language': 'ru-RU'})
+        results = data.get('results', [])
         logger.info(f"Found {len(results)} results for '{title}' in {time.time() - start_time:.2f}s")
         if not results:
             await update.message.reply_text('Фильм не найден. Попробуйте ещё раз или /cancel.', reply_markup=global_keyboard)
             return ADD_TITLE
         if len(results) == 1:
             logger.info(f"Single result found, adding: {results[0]['title']}")
-            return await add_save_film(update, context, results[0])
+            return await add_save_film(update, context, results[0], await genres_task)
         keyboard = []
         for i, film in enumerate(results[:5]):
             year = film.get('release_date', '')[:4]
             keyboard.append([InlineKeyboardButton(f"{film['title']} ({year})", callback_data=str(i))])
         reply_markup = InlineKeyboardMarkup(keyboard)
-        context.user_data['add_results'] = results
+        # Храним только поля, нужные add_save_film, и названия их жанров
+        add_results = [
+            {'id': r['id'], 'title': r['title'], 'genre_ids': r.get('genre_ids', [])} for r in results[:5]
+        ]
+        genres = await genres_task
+        context.user_data['add_results'] = add_results
+        context.user_data['add_genres'] = {
+            gid: genres[gid] for r in add_results for gid in r['genre_ids'] if gid in genres
+        }
         await update.message.reply_text('Выберите нужный фильм:', reply_markup=reply_markup)
         return ADD_CHOICE
-    except httpx.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"TMDB API error: {e}")
         await update.message.reply_text('Ошибка при поиске фильма. Попробуйте ещё раз или /cancel.', reply_markup=global_keyboard)
         return ADD_TITLE
@@ -154,6 +256,12 @@ async def add_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Unexpected error in add_title: {e}")
         await update.message.reply_text('Произошла ошибка. Попробуйте ещё раз или /cancel.', reply_markup=global_keyboard)
         return ADD_TITLE
+    finally:
+        # Жанры не понадобились (ничего не найдено или ошибка) - не оставляем висящую задачу
+        if not genres_task.done():
+            genres_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await genres_task
 
 async def add_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -167,32 +275,27 @@ async def add_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         idx = int(query.data)
         film = context.user_data['add_results'][idx]
-        return await add_save_film(query, context, film)
+        return await add_save_film(query, context, film, context.user_data.get('add_genres') or None)
     except (ValueError, IndexError) as e:
         logger.error(f"Error in add_choice: {e}")
         await query.message.edit_text('Ошибка при выборе фильма. Попробуйте снова.')
         return ConversationHandler.END
 
-async def add_save_film(update_or_query, context, film):
+async def add_save_film(update_or_query, context, film, genres=None):
     try:
-        user_id = str(update_or_query.from_user.id)
-        films = load_films()
-        user_films = films.get(user_id, [])
+        user_id = update_or_query.from_user.id
         
-        # Проверка на дубли
-        if any(f['id'] == film['id'] for f in user_films):
-            await update_or_query.message.reply_text('Этот фильм уже есть в вашем списке.', reply_markup=global_keyboard)
-            return ConversationHandler.END
-            
         # Получаем жанры
-        genres = await get_genres()
-        genre_names = [genres.get(gid, '') for gid in film.get('genre_ids', [])]
+        if genres is None:
+            genres = await get_genres()
+        genre_names = [name for gid in film.get('genre_ids', []) if (name := genres.get(gid))]
         genre_str = f" ({', '.join(genre_names)})" if genre_names else ''
         
-        # Сохраняем
-        user_films.append({'id': film['id'], 'title': film['title'], 'genres': genre_names})
-        films[user_id] = user_films
-        save_films(films)
+        # Сохраняем; дубли отсекает PRIMARY KEY(user_id, film_id)
+        if not await add_user_film(user_id, film['id'], film['title'], genre_names):
+            await update_or_query.message.reply_text('Этот фильм уже есть в вашем списке.', reply_markup=global_keyboard)
+            return ConversationHandler.END
+        context.user_data.pop('seen_ids', None)
         
         logger.info(f"Film added for user {user_id}: {film['title']}")
         await update_or_query.message.reply_text(f'Фильм "{film["title"]}"{genre_str} добавлен!', reply_markup=global_keyboard)
@@ -209,11 +312,7 @@ async def add_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Рекомендации ---
 async def recommend_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton('По фильму', callback_data='by_film')],
-        [InlineKeyboardButton('По жанру', callback_data='by_genre')],
-    ]
-    await update.message.reply_text('Какой тип рекомендации вас интересует?', reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text('Какой тип рекомендации вас интересует?', reply_markup=_RECOMMEND_TYPE_MARKUP)
     return RECOMMEND_CHOOSE
 
 async def recommend_choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -221,14 +320,15 @@ async def recommend_choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     if query.data == 'by_film':
         # Список фильмов пользователя
-        user_id = str(query.from_user.id)
-        films = load_films().get(user_id, [])
+        user_id = query.from_user.id
+        films = await get_user_films(user_id)
         if not films:
             await query.message.edit_text('У вас нет фильмов для рекомендаций.')
             return ConversationHandler.END
         keyboard = [[InlineKeyboardButton(f["title"], callback_data=str(i))] for i, f in enumerate(films)]
         await query.message.edit_text('Выберите фильм:', reply_markup=InlineKeyboardMarkup(keyboard))
-        context.user_data['recommend_films'] = films
+        context.user_data['recommend_films'] = [{'id': f['id'], 'title': f['title']} for f in films]
+        context.user_data['seen_ids'] = {f['id'] for f in films}
         return RECOMMEND_FILM_PICK
     elif query.data == 'by_genre':
         genres = await get_genres()
@@ -240,63 +340,37 @@ async def recommend_choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.edit_text('Неизвестный выбор.')
         return ConversationHandler.END
 
-async def recommend_film_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Одна страница TMDB (20 фильмов) делится на несколько страниц бота
+RECOMMEND_ITEMS_PER_PAGE = 5
+TMDB_RESULTS_PER_PAGE = 20
+
+_RECOMMEND_KINDS = {
+    'film': {'page_key': 'film_page', 'state': RECOMMEND_MORE_FILM},
+    'genre': {'page_key': 'genre_page', 'state': RECOMMEND_MORE_GENRE},
+}
+
+async def _paginate_recommendations(query, context, *, kind, fetch_url, fetch_params, title):
     start_time = time.time()
-    query = update.callback_query
-    await query.answer()
-    if query.data == "close_recommendations":
-        await query.message.edit_text('Рекомендации закрыты.')
-        return ConversationHandler.END
-    elif query.data.startswith("add_rec_"):
-        # Обработка нажатия на фильм в рекомендациях - открываем ссылку на TMDB
-        film_id = query.data.split("_")[2]
-        tmdb_url = f"https://www.themoviedb.org/movie/{film_id}"
-        await query.message.edit_text(f'Открываю фильм на TMDB:\n{tmdb_url}')
-        return ConversationHandler.END
-    elif query.data.startswith("film_page_"):
-        page = int(query.data.split("_")[2])
-        context.user_data['film_page'] = page
-        film = context.user_data['recommend_film']
-    elif query.data == "more_film":
-        page = context.user_data.get('film_page', 1)
-        page += 1
-        context.user_data['film_page'] = page
-        film = context.user_data['recommend_film']
-    else:
-        try:
-            idx = int(query.data)
-            film = context.user_data['recommend_films'][idx]
-            context.user_data['recommend_film'] = film
-            context.user_data['film_page'] = 1
-        except (ValueError, IndexError):
-            await query.message.edit_text('Неизвестный выбор.')
-            return ConversationHandler.END
+    page_key = _RECOMMEND_KINDS[kind]['page_key']
+    state = _RECOMMEND_KINDS[kind]['state']
     try:
-        items_per_page = 5
-        bot_page = context.user_data['film_page']
-        user_id = str(query.from_user.id)
-        user_films = set(f['id'] for f in load_films().get(user_id, []))
-        
-        # Упрощенный поиск - берем первую страницу и фильтруем
-        tmdb_page = (bot_page - 1) // 4 + 1
-        tmdb_results_offset = ((bot_page - 1) % 4) * items_per_page
+        bot_page = context.user_data[page_key]
+        user_films = await get_seen_ids(context, query.from_user.id)
         
-        global http_client
-        if not http_client:
-            http_client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_keepalive_connections=5, max_connections=10))
+        pages_per_tmdb_page = TMDB_RESULTS_PER_PAGE // RECOMMEND_ITEMS_PER_PAGE
+        tmdb_page = (bot_page - 1) // pages_per_tmdb_page + 1
+        start_idx = ((bot_page - 1) % pages_per_tmdb_page) * RECOMMEND_ITEMS_PER_PAGE
+        end_idx = start_idx + RECOMMEND_ITEMS_PER_PAGE
         
-        await tmdb_rate_limiter.acquire()
-        resp = await http_client.get(f'{TMDB_MOVIE_URL}{film["id"]}/recommendations', 
-                                params={'api_key': TMDB_API_KEY, 'language': 'ru-RU', 'page': tmdb_page})
-        resp.raise_for_status()
-        results = resp.json().get('results', [])
+        # Оба запроса идут параллельно; tmdb_get сам берет токен rate limiter'а на каждый
+        data, genres_dict = await asyncio.gather(
+            tmdb_get(fetch_url, {**fetch_params, 'api_key': TMDB_API_KEY, 'language': 'ru-RU', 'page': tmdb_page}),
+            get_genres(),
+        )
+        results = data.get('results', [])
         
         # Фильтруем фильмы, которые пользователь уже видел
         new_films = [f for f in results if f['id'] not in user_films]
-        
-        # Берем нужную порцию для текущей страницы
-        start_idx = tmdb_results_offset
-        end_idx = start_idx + items_per_page
         page_films = new_films[start_idx:end_idx]
         
         if not page_films:
@@ -304,45 +378,88 @@ async def recommend_film_pick(update: Update, context: ContextTypes.DEFAULT_TYPE
             page_films = results[start_idx:end_idx]
         
         if not page_films:
-            await query.message.edit_text('Больше рекомендаций нет.', reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations")
-            ]]))
-            return RECOMMEND_MORE_FILM
+            await query.message.edit_text('Больше рекомендаций нет.', reply_markup=_CLOSE_MARKUP)
+            return state
         
-        text = f'Рекомендации по фильму "{film["title"]}":\n\n'
+        lines = [title, '']
         keyboard = []
         
-        genres_dict = await get_genres()
         for i, rec_film in enumerate(page_films):
-            genres = rec_film.get('genre_ids', [])
-            genre_names = [genres_dict.get(gid, '') for gid in genres if genres_dict.get(gid)]
+            genre_names = [name for gid in rec_film.get('genre_ids', []) if (name := genres_dict.get(gid))]
             genre_text = f" ({', '.join(genre_names)})" if genre_names else ""
-            text += f"{i+1}. {rec_film['title']}{genre_text}\n"
+            lines.append(f"{i+1}. {rec_film['title']}{genre_text}")
             tmdb_url = f"https://www.themoviedb.org/movie/{rec_film['id']}"
             keyboard.append([InlineKeyboardButton(f"{i+1}. {rec_film['title']}", url=tmdb_url)])
         
         # Добавляем навигацию
         nav_buttons = []
         if bot_page > 1:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"film_page_{bot_page-1}"))
-        nav_buttons.append(InlineKeyboardButton("➡️ Ещё", callback_data="more_film"))
-        nav_buttons.append(InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations"))
+            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{kind}_page_{bot_page-1}"))
+        nav_buttons.append(InlineKeyboardButton("➡️ Ещё", callback_data=f"more_{kind}_{bot_page+1}"))
+        nav_buttons.append(_CLOSE_BUTTON)
         keyboard.append(nav_buttons)
         
-        logger.info(f"Film recommendations generated in {time.time() - start_time:.2f}s")
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return RECOMMEND_MORE_FILM
+        logger.info(f"{kind.capitalize()} recommendations generated in {time.time() - start_time:.2f}s")
+        await query.message.edit_text('\n'.join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+        return state
         
     except Exception as e:
-        logger.error(f"Error getting film recommendations: {e}")
-        await query.message.edit_text('Ошибка при получении рекомендаций.', reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations")
-        ]]))
+        logger.error(f"Error getting {kind} recommendations: {e}")
+        await query.message.edit_text('Ошибка при получении рекомендаций.', reply_markup=_CLOSE_MARKUP)
+        return state
+
+async def _drop_stale_more_click(query, context, kind):
+    # Кнопка «Ещё» несёт номер следующей страницы: повторное нажатие с ним уже не совпадёт
+    if not query.data.startswith(f"more_{kind}_"):
+        return False
+    expected = int(query.data.rsplit("_", 1)[1])
+    if context.user_data.get(f'{kind}_page', 1) + 1 == expected:
+        return False
+    await query.answer('Уже обрабатывается')
+    return True
+
+async def recommend_film_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if await _drop_stale_more_click(query, context, 'film'):
         return RECOMMEND_MORE_FILM
+    await query.answer()
+    if query.data == "close_recommendations":
+        await query.message.edit_text('Рекомендации закрыты.')
+        return ConversationHandler.END
+    elif query.data.startswith("add_rec_"):
+        # Обработка нажатия на фильм в рекомендациях - открываем ссылку на TMDB
+        film_id = query.data.split("_")[2]
+        tmdb_url = f"https://www.themoviedb.org/movie/{film_id}"
+        await query.message.edit_text(f'Открываю фильм на TMDB:\n{tmdb_url}')
+        return ConversationHandler.END
+    elif query.data.startswith("film_page_"):
+        page = int(query.data.split("_")[2])
+        context.user_data['film_page'] = page
+        film = context.user_data['recommend_film']
+    elif query.data.startswith("more_film_"):
+        page = int(query.data.rsplit("_", 1)[1])
+        context.user_data['film_page'] = page
+        film = context.user_data['recommend_film']
+    else:
+        try:
+            idx = int(query.data)
+            film = context.user_data['recommend_films'][idx]
+            context.user_data['recommend_film'] = film
+            context.user_data['film_page'] = 1
+        except (ValueError, IndexError):
+            await query.message.edit_text('Неизвестный выбор.')
+            return ConversationHandler.END
+    return await _paginate_recommendations(
+        query, context, kind='film',
+        fetch_url=f'{TMDB_MOVIE_URL}{film["id"]}/recommendations',
+        fetch_params={},
+        title=f'Рекомендации по фильму "{film["title"]}":',
+    )
 
 async def recommend_genre_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    start_time = time.time()
     query = update.callback_query
+    if await _drop_stale_more_click(query, context, 'genre'):
+        return RECOMMEND_MORE_GENRE
     await query.answer()
     
     logger.info(f"Genre pick callback data: {query.data}")
@@ -356,9 +473,8 @@ async def recommend_genre_pick(update: Update, context: ContextTypes.DEFAULT_TYP
         tmdb_url = f"https://www.themoviedb.org/movie/{film_id}"
         await query.message.edit_text(f'Открываю фильм на TMDB:\n{tmdb_url}')
         return ConversationHandler.END
-    elif query.data == "more_genre":
-        page = context.user_data.get('genre_page', 1)
-        page += 1
+    elif query.data.startswith("more_genre_"):
+        page = int(query.data.rsplit("_", 1)[1])
         context.user_data['genre_page'] = page
         genre_id = context.user_data['recommend_genre_id']
     elif query.data.startswith("genre_page_"):
@@ -370,71 +486,22 @@ async def recommend_genre_pick(update: Update, context: ContextTypes.DEFAULT_TYP
             genre_id = int(query.data)
             context.user_data['recommend_genre_id'] = genre_id
             context.user_data['genre_page'] = 1
+            context.user_data.pop('seen_ids', None)
             logger.info(f"Selected genre ID: {genre_id}")
         except ValueError:
             logger.error(f"Invalid genre selection: {query.data}")
             await query.message.edit_text('Неизвестный выбор.')
             return ConversationHandler.END
-    
-    try:
+        # Список жанров только что показывался, так что он уже в кэше
         genres_dict = await get_genres()
-        genre_name = genres_dict.get(genre_id, 'Неизвестный жанр')
-        page = context.user_data['genre_page']
-        user_id = str(query.from_user.id)
-        user_films = set(f['id'] for f in load_films().get(user_id, []))
-        
-        global http_client
-        if not http_client:
-            http_client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_keepalive_connections=5, max_connections=10))
-        
-        await tmdb_rate_limiter.acquire()
-        resp = await http_client.get(f'{TMDB_DISCOVER_URL}', 
-                                params={'api_key': TMDB_API_KEY, 'language': 'ru-RU', 'with_genres': genre_id, 'page': page})
-        resp.raise_for_status()
-        results = resp.json().get('results', [])
-        
-        # Фильтруем фильмы, которые пользователь уже видел
-        new_films = [f for f in results if f['id'] not in user_films]
-        
-        if not new_films:
-            # Если нет новых фильмов, берем любые
-            new_films = results[:5]
-        
-        if not new_films:
-            await query.message.edit_text('Больше рекомендаций нет.', reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations")
-            ]]))
-            return RECOMMEND_MORE_GENRE
-        
-        text = f'Рекомендации по жанру "{genre_name}":\n\n'
-        keyboard = []
-        
-        for i, rec_film in enumerate(new_films):
-            genres = rec_film.get('genre_ids', [])
-            genre_names = [genres_dict.get(gid, '') for gid in genres if genres_dict.get(gid)]
-            genre_text = f" ({', '.join(genre_names)})" if genre_names else ""
-            text += f"{i+1}. {rec_film['title']}{genre_text}\n"
-            tmdb_url = f"https://www.themoviedb.org/movie/{rec_film['id']}"
-            keyboard.append([InlineKeyboardButton(f"{i+1}. {rec_film['title']}", url=tmdb_url)])
-        
-        # Добавляем навигацию
-        nav_buttons = []
-        if page > 1:
-            nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"genre_page_{page-1}"))
-        nav_buttons.append(InlineKeyboardButton("➡️ Ещё", callback_data="more_genre"))
-        nav_buttons.append(InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations"))
-        keyboard.append(nav_buttons)
-        
-        logger.info(f"Genre recommendations generated in {time.time() - start_time:.2f}s")
-        await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
-        return RECOMMEND_MORE_GENRE
-        
-    except Exception as e:
-        logger.error(f"Error getting genre recommendations: {e}")
-        await query.message.edit_text('Ошибка при получении рекомендаций.', reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("❌ Закрыть", callback_data="close_recommendations")
-        ]]))
-        return RECOMMEND_MORE_GENRE
+        context.user_data['recommend_genre_name'] = genres_dict.get(genre_id, 'Неизвестный жанр')
+    genre_name = context.user_data.get('recommend_genre_name', 'Неизвестный жанр')
+    return await _paginate_recommendations(
+        query, context, kind='genre',
+        fetch_url=TMDB_DISCOVER_URL,
+        fetch_params={'with_genres': genre_id},
+        title=f'Рекомендации по жанру "{genre_name}":',
+    )
 
 async def recommend_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text('Рекомендации отменены.', reply_markup=global_keyboard)
@@ -447,8 +514,8 @@ async def close_recommendations(update: Update, context: ContextTypes.DEFAULT_TY
     return ConversationHandler.END
 
 async def list_films(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.message.from_user.id)
-    films = load_films().get(user_id, [])
+    user_id = update.message.from_user.id
+    films = await get_user_films(user_id)
     if not films:
         await update.message.reply_text('Ваш список фильмов пуст.', reply_markup=global_keyboard)
         return ConversationHandler.END
@@ -456,15 +523,10 @@ async def list_films(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем фильмы в контексте для последующего удаления
     context.user_data['list_films'] = films
     
-    text = 'Ваши фильмы:\n'
-    for i, film in enumerate(films, 1):
-        genres = f" ({', '.join(film['genres'])})" if film['genres'] else ''
-        text += f"{i}. {film['title']}{genres}\n"
+    text = format_films_text('Ваши фильмы:', films)
     
     # Добавляем кнопку "Удалить" внизу списка
-    keyboard = [[InlineKeyboardButton("🗑️ Удалить фильм", callback_data="show_delete_interface")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(text, reply_markup=reply_markup)
+    await update.message.reply_text(text, reply_markup=_SHOW_DELETE_MARKUP)
     return LIST_SHOW
 
 # --- ConversationHandler для /add ---
@@ -503,7 +565,7 @@ async def list_delete_film(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard.append([InlineKeyboardButton(f"❌ {button_text}", callback_data=f"delete_{i}")])
         
         # Добавляем кнопку "Отмена"
-        keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel_delete")])
+        keyboard.append(_CANCEL_DELETE_ROW)
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.edit_text(text, reply_markup=reply_markup)
@@ -512,14 +574,9 @@ async def list_delete_film(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == "cancel_delete":
         # Возвращаемся к обычному списку
         films = context.user_data.get('list_films', [])
-        text = 'Ваши фильмы:\n'
-        for i, film in enumerate(films, 1):
-            genres = f" ({', '.join(film['genres'])})" if film['genres'] else ''
-            text += f"{i}. {film['title']}{genres}\n"
+        text = format_films_text('Ваши фильмы:', films)
         
-        keyboard = [[InlineKeyboardButton("🗑️ Удалить фильм", callback_data="show_delete_interface")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(text, reply_markup=reply_markup)
+        await query.message.edit_text(text, reply_markup=_SHOW_DELETE_MARKUP)
         return LIST_SHOW
     
     elif query.data == "show_updated_list":
@@ -530,14 +587,9 @@ async def list_delete_film(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text('Ваш список фильмов пуст.', reply_markup=global_keyboard)
             return ConversationHandler.END
         
-        text = 'Обновленный список фильмов:\n'
-        for i, film in enumerate(films, 1):
-            genres = f" ({', '.join(film['genres'])})" if film['genres'] else ''
-            text += f"{i}. {film['title']}{genres}\n"
+        text = format_films_text('Обновленный список фильмов:', films)
         
-        keyboard = [[InlineKeyboardButton("🗑️ Удалить фильм", callback_data="show_delete_interface")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.edit_text(text, reply_markup=reply_markup)
+        await query.message.edit_text(text, reply_markup=_SHOW_DELETE_MARKUP)
         return LIST_SHOW
     
     elif query.data.startswith("delete_"):
@@ -552,15 +604,14 @@ async def list_delete_film(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Получаем информацию о фильме перед удалением
             film_to_delete = films[film_index]
-            user_id = str(query.from_user.id)
+            user_id = query.from_user.id
             
             # Удаляем фильм из списка
             films.pop(film_index)
             
-            # Сохраняем обновленный список
-            all_films = load_films()
-            all_films[user_id] = films
-            save_films(all_films)
+            # Удаляем фильм из базы
+            await delete_user_film(user_id, film_to_delete['id'])
+            context.user_data.pop('seen_ids', None)
             
             logger.info(f"Film deleted for user {user_id}: {film_to_delete['title']}")
             
@@ -569,9 +620,7 @@ async def list_delete_film(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Если остались фильмы, показываем обновленный список
             if films:
-                keyboard = [[InlineKeyboardButton("📋 Показать обновленный список", callback_data="show_updated_list")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.message.reply_text("Хотите посмотреть обновленный список?", reply_markup=reply_markup)
+                await query.message.reply_text("Хотите посмотреть обновленный список?", reply_markup=_SHOW_UPDATED_LIST_MARKUP)
                 context.user_data['list_films'] = films  # Обновляем список в контексте
                 return LIST_SHOW
             else:
@@ -617,36 +666,85 @@ recommend_conv = ConversationHandler(
     per_message=False,
 )
 
+# --- Маршрутизация callback-кнопок вне ConversationHandler ---
+_CALLBACK_EXACT = {
+    'show_delete_interface': list_delete_film,
+    'cancel_delete': list_delete_film,
+    'show_updated_list': list_delete_film,
+    'by_film': recommend_choose,
+    'by_genre': recommend_choose,
+    'close_recommendations': recommend_film_pick,
+}
+_CALLBACK_PREFIXES = (
+    ('delete_', list_delete_film),
+    ('film_page_', recommend_film_pick),
+    ('more_film_', recommend_film_pick),
+    ('add_rec_', recommend_film_pick),
+    ('genre_page_', recommend_genre_pick),
+    ('more_genre_', recommend_genre_pick),
+)
+
 async def universal_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = update.callback_query.data
-    # Удаление фильмов
-    if data.startswith('delete_') or data in ['show_delete_interface', 'cancel_delete', 'show_updated_list']:
-        return await list_delete_film(update, context)
-    # Рекомендации: выбор типа
-    elif data in ['by_film', 'by_genre']:
-        return await recommend_choose(update, context)
-    # Рекомендации по фильму
-    elif data.startswith('film_page_') or data == 'more_film' or data == 'close_recommendations' or data.startswith('add_rec_') or (data.isdigit() and 'recommend_films' in context.user_data):
-        return await recommend_film_pick(update, context)
-    # Рекомендации по жанру (первый выбор жанра или навигация)
-    elif data.startswith('genre_page_') or data == 'more_genre' or data.startswith('add_rec_') or data == 'close_recommendations' or (data.isdigit() and 'recommend_genre_id' in context.user_data):
-        return await recommend_genre_pick(update, context)
-    # Добавление фильма (выбор из поиска)
-    elif data.isdigit() and 'add_results' in context.user_data:
-        return await add_choice(update, context)
-    else:
-        await update.callback_query.answer()
-        await update.callback_query.message.edit_text('Сессия устарела, начните заново.')
-        return ConversationHandler.END
+    handler = _CALLBACK_EXACT.get(data)
+    if handler:
+        return await handler(update, context)
+    for prefix, handler in _CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return await handler(update, context)
+    # Числовые кнопки: выбор фильма/жанра в рекомендациях или фильма из поиска
+    if data.isdigit():
+        if 'recommend_films' in context.user_data:
+            return await recommend_film_pick(update, context)
+        if 'recommend_genre_id' in context.user_data:
+            return await recommend_genre_pick(update, context)
+        if 'add_results' in context.user_data:
+            return await add_choice(update, context)
+    await update.callback_query.answer()
+    await update.callback_query.message.edit_text('Сессия устарела, начните заново.')
+    return ConversationHandler.END
 
 # --- Основной запуск ---
+async def init_http_client():
+    global http_client
+    # http2=True требует пакет h2 (httpx[http2]), иначе здесь будет ImportError
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0),
+        headers={'Accept-Encoding': 'gzip'},
+    )
+    # Прогреваем соединение, чтобы первый запрос пользователя не ждал TCP+TLS
+    try:
+        resp = await http_client.get(TMDB_CONFIGURATION_URL, params={'api_key': TMDB_API_KEY})
+        # Если сервер не согласует h2 через ALPN, соединение остаётся на HTTP/1.1
+        logger.info(f"TMDB connection ready ({resp.http_version})")
+    except httpx.HTTPError as e:
+        logger.warning(f"TMDB warm-up failed: {e}")
+
 async def cleanup():
     global http_client
     if http_client:
         await http_client.aclose()
+        http_client = None
+
+async def on_startup(app):
+    await init_db()
+    await init_http_client()
+
+async def on_shutdown(app):
+    await cleanup()
+    await close_db()
 
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Сначала ConversationHandler для состояний
     app.add_handler(add_conv)
@@ -663,9 +761,6 @@ def main():
     # Universal CallbackQueryHandler должен быть последним
     app.add_handler(CallbackQueryHandler(universal_callback_handler))
     
-    # Обработка завершения работы
-    app.add_handler(CommandHandler('shutdown', lambda u, c: cleanup()))
-    
     # Запуск с обработкой ошибок
     try:
         app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
@@ -673,13 +768,6 @@ def main():
         logger.info("Bot stopped by user")
     except Exception as e:
         logger.error(f"Bot crashed: {e}")
-    finally:
-        # Очистка ресурсов
-        import asyncio
-        try:
-            asyncio.run(cleanup())
-        except:
-            pass
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file